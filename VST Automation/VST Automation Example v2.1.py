@@ -17,24 +17,101 @@
 
 import os
 import json
+import functools
+import atexit
 import time
-import regex
+import random
+import re
 import subprocess
-from shutil import copy
+from shutil import copy, copymode, SameFileError
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
+
+# Precompiled patterns for reading payoffs and control values from output
+_PAYOFF_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?')
+_DIGITS_RE = re.compile(r'\d+')
+
+# Suppress console window for each child process (flag only exists on Windows)
+_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+
+def _fastcopy(src, dst):
+    """Copy file `src` to `dst` (file or directory), using in-kernel
+    copy_file_range or sendfile where available and falling back to a
+    buffered read/write loop otherwise
+    """
+    if os.path.isdir(dst):  # Mirror shutil.copy handling of directory dst
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):  # O_TRUNC would empty src
+        raise SameFileError(f"{src!r} and {dst!r} are the same file")
+    binary = getattr(os, 'O_BINARY', 0)  # Needed on Windows to avoid newline translation
+    infd = os.open(src, os.O_RDONLY | binary)
+    try:
+        outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | binary, 0o666)
+        try:
+            size, copied = os.fstat(infd).st_size, 0
+            try:  # Kernel-side copy, can reflink on CoW / NFS (Linux only)
+                while copied < size:
+                    sent = os.copy_file_range(infd, outfd, size - copied, copied, copied)
+                    if not sent:
+                        break
+                    copied += sent
+            except (AttributeError, OSError):
+                try:  # Kernel-side copy via sendfile (not available on Windows)
+                    os.lseek(outfd, copied, os.SEEK_SET)
+                    while copied < size:
+                        sent = os.sendfile(outfd, infd, copied, size - copied)
+                        if not sent:
+                            break
+                        copied += sent
+                except (AttributeError, OSError):  # Plain buffered copy as last resort
+                    os.lseek(infd, copied, os.SEEK_SET)
+                    os.lseek(outfd, copied, os.SEEK_SET)
+                    while True:
+                        buf = os.read(infd, 256 * 1024)
+                        if not buf:
+                            break
+                        os.write(outfd, buf)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+    copymode(src, dst)  # Copy permission bits as shutil.copy does
+
+
+@functools.lru_cache(maxsize=32)
+def _build_header(model, settings, data):
+    """Build .cmd header lines that depend only on simcontrol settings, 
+    cached so Scripts sharing settings reuse them; `settings` is a tuple 
+    of (name, value) pairs, `data` a tuple of data files or None
+    """
+    cmdtext = ["SPECIAL>NOINTERACTION\n", f"SPECIAL>LOADMODEL|{model}\n"]
+    
+    for s, v in settings:
+        cmdtext.append(f"SIMULATE>{s}|{v}\n")
+    
+    if data is not None:
+        cmdtext.append(f"SIMULATE>DATA|\"{','.join(data)}\"\n")
+    
+    return tuple(cmdtext)
+
 
 class Script(object):
     """Master object for holding and modifying .cmd script settings, 
     creating .cmd files, and running them through Vensim/Vengine"""
     def __init__(self, controlfile):
         print("Initialising", self)
-        for k, v in controlfile['simsettings'].items():
-            self.__setattr__(k, v if isinstance(v, str) else v.copy())
+        for k, v in controlfile['simsettings'].items():  # Fresh lists, since changes etc. get mutated
+            self.__dict__[k] = v if isinstance(v, str) else v.copy()
         self.setvals = []
         self.runcmd = "SIMULATE>REPORT|1\nMENU>RUN_OPTIMIZE|o\n"
         self.savecmd = f"MENU>VDF2TAB|!|!|{self.savelist}|\n"
         self.basename = controlfile['baserunname']
         self.cmdtext = []
         
+        # Record which simsettings settings are present, for use in write_script
+        self._cmd_attrs = tuple(s for s in ['payoff', 'sensitivity', 'optparm', 
+                                            'savelist', 'senssavelist'] if hasattr(self, s))
+        
     def copy_model_files(self, dirname):
         """Create subdirectory and copy relevant model files to it,
         then change working directory to subdirectory"""
@@ -42,40 +119,38 @@ class Script(object):
         os.chdir(f"./{dirname}")
 
         # Copy needed files from the working directory into the sub-directory
-        for s in ['model', 'payoff', 'optparm', 'sensitivity', 'savelist', 'senssavelist']:
-            if getattr(self, s):
-                copy(f"../{getattr(self, s)}", "./")
+        files = [getattr(self, s) for s in ['model', 'payoff', 'optparm', 'sensitivity', 
+                                            'savelist', 'senssavelist'] if getattr(self, s)]
         for slist in ['data', 'changes']:
-            for file in getattr(self, slist):
-                copy(f"../{file}", "./")
+            files.extend(getattr(self, slist))
+        with ThreadPoolExecutor(max_workers=8) as executor:  # Copy concurrently
+            list(executor.map(lambda file: _fastcopy(f"../{file}", "./"), files))
         
     def add_suffixes(self, settingsfxs):
         """Modify mdl, voc, etc. with suffixes specified as dict"""
         for s, sfx in settingsfxs.items():
             if hasattr(self, s):
-                self.__setattr__(s, getattr(self, s)[:-4] + sfx + getattr(self, s)[-4:])
+                self.__dict__[s] = getattr(self, s)[:-4] + sfx + getattr(self, s)[-4:]
    
     def update_changes(self, chglist, setvals=[]):
         """Combines and flattens list of paired names & suffixes for 
         changes, and appends to changes setting; also updates setvals"""
-        flat = [i for s in 
-                [[f"{self.basename}_{n}_{sfx}.out" for n in name] if isinstance(name, list) 
-                 else [f"{self.basename}_{name}_{sfx}.out"] for name, sfx in chglist] for i in s]
+        prefix = self.basename + "_"
+        flat = []
+        for name, sfx in chglist:
+            suffix = "_" + sfx + ".out"
+            if isinstance(name, list):  # Expand list of names paired with one suffix
+                flat.extend(prefix + n + suffix for n in name)
+            else:
+                flat.append(prefix + name + suffix)
         self.changes.extend(flat)
         self.setvals = setvals
         
     def write_script(self, scriptname):
         """Write actual .cmd file based on controlfile attributes"""
-        self.cmdtext.extend(["SPECIAL>NOINTERACTION\n", 
-                             f"SPECIAL>LOADMODEL|{self.model}\n"])
-        
-        for s in ['payoff', 'sensitivity', 'optparm', 'savelist', 'senssavelist']:
-            if hasattr(self, s):
-                self.cmdtext.append(f"SIMULATE>{s}|{getattr(self, s)}\n")
-        
-        if hasattr(self, 'data'):
-            datatext = ','.join(self.data)
-            self.cmdtext.append(f"SIMULATE>DATA|\"{','.join(self.data)}\"\n")
+        self.cmdtext.extend(_build_header(
+            self.model, tuple((s, getattr(self, s)) for s in self._cmd_attrs), 
+            tuple(self.data) if hasattr(self, 'data') else None))  # Cached header
 
         if hasattr(self, 'changes'):
             if self.changes:
@@ -92,8 +167,9 @@ class Script(object):
         self.cmdtext.extend([self.runcmd, self.savecmd, 
                              "SPECIAL>CLEARRUNS\n", "MENU>EXIT\n"])
         
-        with open(f"{scriptname}.cmd", 'w') as scriptfile:
-            scriptfile.writelines(self.cmdtext)
+        # Join once and write in a single call through a 256 KiB buffer
+        with open(f"{scriptname}.cmd", 'w', buffering=1 << 18) as scriptfile:
+            scriptfile.write(''.join(self.cmdtext))
 
     def run_script(self, scriptname, controlfile, subdir, logfile):
         """Run the compiled .cmd file, calling Vengine by default"""
@@ -164,11 +240,24 @@ def compile_script(controlfile, scriptclass, name, namesfx, settingsfxs,
     return mainscript.run_script(scriptname, controlfile, subdir, logfile)
 
 
+_LOG_HANDLES = {}  # Open line-buffered logfile handles, keyed by logfile path
+
+
 def write_log(string, logfile):
-    """Writes printed script output to a logfile"""
-    with open(logfile,'a') as f:
-        f.write(string + "\n")
+    """Writes printed script output to a logfile, keeping the logfile 
+    open for reuse by later calls"""
+    f = _LOG_HANDLES.get(logfile)
+    if f is None:
+        f = _LOG_HANDLES[logfile] = open(logfile, 'a', buffering=1)
+    f.write(string + "\n")
     print(string)
+
+
+@atexit.register
+def _close_logs():
+    """Close any logfiles opened by `write_log` on interpreter exit"""
+    for f in _LOG_HANDLES.values():
+        f.close()
     
 
 def read_payoff(outfile, logfile):
@@ -181,11 +270,16 @@ def read_payoff(outfile, logfile):
     else:
         write_log(f"Warning: attempting to read payoff from {outfile}", logfile)
     
-    with open(outfile, 'r') as f:
-        payoffline = f.readlines()[line]
-    payoffvalue = [float(s) for s in 
-                   regex.findall(r'-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?', payoffline)][0]
-    return payoffvalue
+    path = os.path.abspath(outfile)  # Key cache on absolute path & mtime so rewrites are reread
+    return _parse_payoff(path, line, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_payoff(path, line, mtime_ns):
+    """Reads payoff value from specified line of file; cached by `read_payoff`"""
+    with open(path, 'r') as f:  # Read only up to the needed line
+        payoffline = next(islice(f, line, line + 1))
+    return float(_PAYOFF_RE.search(payoffline).group(0))  # Only first match needed
 
 
 # ### Script running functions
@@ -201,6 +295,33 @@ def read_payoff(outfile, logfile):
 # In[ ]:
 
 
+def _retry_delay(attempts, base=1.0, cap=30.0):
+    """Full-jitter exponential backoff: random delay in seconds before 
+    retry number `attempts`, up to base * 2**attempts (capped at `cap`)"""
+    return random.uniform(0, min(cap, base * 2 ** attempts))
+
+
+def _wait_for_file(path, timeout=2.0):
+    """Poll `path` with exponential backoff (from 10ms, capped at 200ms) 
+    for up to `timeout` seconds until it exists and its size is stable 
+    across two polls, i.e. has been flushed; return whether it exists"""
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    lastsize = -1
+    while True:
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = -1
+        if size >= 0 and size == lastsize:  # Exists and no longer growing
+            return True
+        if time.monotonic() >= deadline:
+            return size >= 0
+        lastsize = size
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
 def run_vengine_script(scriptname, venginepath, timelimit, checkfile, check_func, logfile):
     """Call Vengine with command script using subprocess; monitor output 
     file for changes to see if Vengine has stalled out, and restart if 
@@ -209,37 +330,35 @@ def run_vengine_script(scriptname, venginepath, timelimit, checkfile, check_func
 
     write_log(f"Initialising {scriptname}!", logfile)
 
+    attempts = 0 # Track attempts to pace retries
     while True:
-        proc = subprocess.Popen(f"{venginepath} \"./{scriptname}.cmd\"")
-        time.sleep(2)
-        # press('enter') # Necessary to bypass the popup message in Vengine
+        attempts += 1
+        proc = subprocess.Popen([venginepath, f"./{scriptname}.cmd"], creationflags=_NO_WINDOW)
+        checkpath = f"./{scriptname}{checkfile}"
+        last_mtime = None # Output file mtime as of previous timeout check
         while True:
             try: # See if run completes within timelimit
                 proc.wait(timeout=timelimit)
                 break
             except subprocess.TimeoutExpired: # If timelimit reached, check run status
-                try: # If Vengine gives error popup on exit, attempt to bypass it
-                    print("Attempting bypass...")
-                    # press('enter')
-                    proc.wait(3) # Process should complete if bypass successful
-                    break
-                except subprocess.TimeoutExpired:
-                    try: # If bypass unsuccessful, check if run still going
-                        write_log(f"Checking for {scriptname}{checkfile}...", logfile)
-                        timelag = time.time() - os.path.getmtime(f"./{scriptname}{checkfile}")                        
-                        if timelag < (timelimit): # Compare time since last output with timelimit
-                            write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output, "
-                                      "continuing...", logfile)
-                            continue
-                        else: # If run seems to have stalled out, kill and restart
-                            proc.kill()
-                            write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output. "
-                                      "Calibration timed out!", logfile)
-                            break
-                    except FileNotFoundError: # If check fails, kill and restart
+                try: # Check if run still going, i.e. output updated since last check
+                    write_log(f"Checking for {scriptname}{checkfile}...", logfile)
+                    mtime = os.stat(checkpath).st_mtime
+                    timelag = time.time() - mtime
+                    if mtime != last_mtime: # Output has advanced since last check
+                        last_mtime = mtime
+                        write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output, "
+                                  "continuing...", logfile)
+                        continue
+                    else: # If run seems to have stalled out, kill and restart
                         proc.kill()
-                        write_log("Calibration timed out!", logfile)
+                        write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output. "
+                                  "Calibration timed out!", logfile)
                         break
+                except FileNotFoundError: # If check fails, kill and restart
+                    proc.kill()
+                    write_log("Calibration timed out!", logfile)
+                    break
         # Check if process successfully completed or bugged out / was killed
         # if proc.returncode != 1:  # Note that Vengine returns 1 on MENU>EXIT, not 0!
         ### TODO: Update this when Vengine return codes are fixed
@@ -248,6 +367,7 @@ def run_vengine_script(scriptname, venginepath, timelimit, checkfile, check_func
         if not (proc.returncode == 0 or proc.returncode == 3221225477):
             write_log(f"Return code is {proc.returncode}", logfile)
             write_log("Vensim! Trying again...", logfile)
+            time.sleep(_retry_delay(attempts)) # Back off to avoid hammering Vensim
             continue
         try: # If process completed successfully, run final check for errors in output
             if check_func(scriptname, logfile):
@@ -256,9 +376,7 @@ def run_vengine_script(scriptname, venginepath, timelimit, checkfile, check_func
             write_log("Outfile not found! That's it, I'm dead.", logfile)
             pass
     
-    time.sleep(2)
-
-    if os.path.exists(f"./{scriptname}.out"):
+    if _wait_for_file(f"./{scriptname}.out"): # Give outfile a moment to appear if needed
         payoffvalue = read_payoff(f"{scriptname}.out", logfile)
         write_log(f"Payoff for {scriptname} is {payoffvalue}, calibration complete!", logfile)
         return payoffvalue # For optimisation runs, return payoff
@@ -272,18 +390,25 @@ def run_vensim_script(scriptname, vensimpath, maxattempts, logfile):
     attempts = 0
     while attempts < maxattempts:
         attempts += 1 # Track & update number of attempts to prevent infinite loop
-        if os.path.exists(f"./{scriptname}.tab"):
-            os.remove(f"./{scriptname}.tab") # Delete old output tabfile if needed
+        try: # Delete old output tabfile if needed, without a separate existence check
+            os.remove(f"./{scriptname}.tab")
+        except FileNotFoundError:
+            pass
         try:
-            subprocess.run(f"{vensimpath} \"./{scriptname}.cmd\"", check=True)
+            subprocess.run([vensimpath, f"./{scriptname}.cmd"], check=True, 
+                           creationflags=_NO_WINDOW)
             pass
         except subprocess.CalledProcessError:
             print("Vensim! Trying again...")
+            if attempts < maxattempts: # Back off before retrying
+                time.sleep(_retry_delay(attempts))
             continue
         if os.path.exists(f"./{scriptname}.tab"): # Check for output tabfile
             break
         else:
             write_log(f"Help! {scriptname} is being repressed!", logfile)
+            if attempts < maxattempts: # Back off before retrying
+                time.sleep(_retry_delay(attempts))
             continue
     
     if os.path.exists(f"./{scriptname}.out"):
@@ -305,24 +430,18 @@ def check_zeroes(scriptname):
     Vengine error), return True if any parameters zeroed OR if # runs = 
     # restarts, and False otherwise"""
     filename = f"{scriptname}.out"
-    with open(filename,'r') as f0:
-        filedata = f0.readlines()
-    
-    checklist = []
-    for line in filedata:
-        if line[0] != ':': # Include only parameter lines
-            if ' = 0 ' in line:
-                checklist.append(True)
-            else:
-                checklist.append(False)
-        elif ':RESTART_MAX' in line:
-            restarts = regex.findall(r'\d+', line)[0]
+    restarts = 0  # Assign default value
+    with open(filename,'r') as f0:  # Stream lines rather than loading whole file
+        first = f0.readline()
+        for line in chain([first], f0):
+            if line[0] != ':': # Include only parameter lines
+                if ' = 0 ' in line:
+                    return True  # Stop at first zeroed parameter
+            elif ':RESTART_MAX' in line:
+                restarts = _DIGITS_RE.search(line).group(0)
     
     # Ensure number of simulations != number of restarts
-    if f"After {restarts} simulations" in filedata[0]:
-        checklist.append(True)
-    
-    return any(checklist)
+    return f"After {restarts} simulations" in first
 
 
 # In[ ]:
@@ -332,8 +451,7 @@ controlfilename = input("Enter control file name (with extension):")
 cf = json.load(open(controlfilename, 'r'))
 
 # Unpack controlfile into variables
-for k,v in cf.items():
-    exec(k + '=v')
+globals().update(cf)
 
 # Set up files in run directory and initialise logfile
 master = Script(cf)
@@ -349,7 +467,7 @@ write_log(f"Optimization complete - payoff is {payoff}!", logfile)
 
 # Run a simple model simulation
 write_log(f"More work? Okay!", logfile)
-time.sleep(2)
+_wait_for_file(f"./{baserunname}_main_opt.out")  # Make sure changes file is in place
 compile_script(cf, RunScript, 'main', 'run', {}, logfile, chglist=[('main', 'opt')])
 write_log("Job done!", logfile)
 
@@ -16,6 +16,8 @@
 # 
 # It returns a simple Python list of fractions of PSRF values post-burnin below the specified thresholds (in order). As an intermediate step, it also generates `runname_MCMC_stats.tab`, containing various MCMC summary stats in more readable tabular format than Vensim's default `.dat` output.
 # 
+# The parsed PSRF values are also cached in `runname_MCMC_psrf.pkl`, keyed to the modification time and size of the `.tab` file they were parsed from, and each successful conversion records the `.dat` and `.tab` files involved in `runname_MCMC_psrf.key`; rerunning the widget on an unchanged `.dat` file (e.g. to try different thresholds) skips the Vensim conversion and tabfile parsing.
+# 
 # Please contact [Tse Yang Lim](mailto:tylim@mit.edu) with any questions or suggestions.
 # 
 # #### TODO:
@@ -25,14 +27,75 @@
 
 
 import os
+import sys
 import time
+import random
+import pickle
+import argparse
+import tempfile
 import subprocess
 import numpy as np
 import pandas as pd
 
-def compile_psrf(runname, vensimpath):
+def _file_key(path):
+    """Return (modification time, size) of file at `path`, used to check 
+    cached results are current, or None if file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _write_pickle(obj, path):
+    """Pickle `obj` to `path`, writing to a temp file first so a partial 
+    file is never read
+    """
+    with tempfile.NamedTemporaryFile('wb', dir='.', delete=False) as f:
+        pickle.dump(obj, f)
+    os.replace(f.name, path)
+
+
+def _read_pickle(path):
+    """Return unpickled contents of `path`, or None if missing or unreadable"""
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+
+
+def _tab_current(runname):
+    """Check whether tabfile was converted by `compile_psrf` from the 
+    current .dat file and has not changed since
+    """
+    datkey = _file_key(f"./{runname}_MCMC_stats.dat")
+    tabkey = _file_key(f"./{runname}_MCMC_stats.tab")
+    if datkey is None or tabkey is None:
+        return False
+    return _read_pickle(f"{runname}_MCMC_psrf.key") == (datkey, tabkey)
+
+
+def _read_psrf_cache(runname):
+    """Return cached PSRF DataFrame if parsed from current tabfile, otherwise None"""
+    tabkey = _file_key(f"./{runname}_MCMC_stats.tab")
+    cached = _read_pickle(f"{runname}_MCMC_psrf.pkl")
+    if tabkey is None or cached is None or cached[0] != tabkey:
+        return None
+    return cached[1]
+
+
+def _write_psrf_cache(runname, psrfs, tabkey):
+    """Cache PSRF DataFrame keyed by tabfile it was parsed from"""
+    if tabkey is not None:
+        _write_pickle((tabkey, psrfs), f"{runname}_MCMC_psrf.pkl")
+
+
+def compile_psrf(runname, vensimpath, maxattempts=10):
     """Using Vensim, convert MCMC_stats.dat output into tab file with 
-    PSRF values (and other MCMC summary stats) for each simulation
+    PSRF values (and other MCMC summary stats) for each simulation; try 
+    up to `maxattempts` times
     """
     # Compile .cmd script to convert stats .dat to tabfile
     cmdtext = [
@@ -47,55 +110,109 @@ def compile_psrf(runname, vensimpath):
     with open(f"{runname}_PSRF.cmd", 'w') as scriptfile:
         scriptfile.writelines(cmdtext)
 
-    if os.path.exists(f"./{runname}_MCMC_stats.dat"):  # Make sure .dat file exists
+    if _tab_current(runname):  # Skip conversion if .dat file unchanged since last conversion
+        print(f"{runname}_MCMC_stats.dat unchanged, using existing tabfile")
+    elif os.path.exists(f"./{runname}_MCMC_stats.dat"):  # Make sure .dat file exists
         # Run .dat conversion with Vensim
-        while True:  # Keep trying until tabfile created successfully
-            subprocess.run(f"{vensimpath} \"./{runname}_PSRF.cmd\"")
-            time.sleep(1)
+        attempts = 0
+        while attempts < maxattempts:  # Keep trying until tabfile created successfully
+            attempts += 1  # Track & update number of attempts to prevent infinite loop
+            try:  # Delete stale tabfile so it can't be mistaken for new output
+                os.remove(f"./{runname}_MCMC_stats.tab")
+            except FileNotFoundError:
+                pass
+            subprocess.run([vensimpath, f"./{runname}_PSRF.cmd"],  # Blocks until Vensim exits
+                           creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))  # Windows only
             if os.path.exists(f"./{runname}_MCMC_stats.tab"):
-                break  # If tabfile exists, move on
+                # Record which .dat file the tabfile was converted from, then move on
+                _write_pickle((_file_key(f"./{runname}_MCMC_stats.dat"), 
+                               _file_key(f"./{runname}_MCMC_stats.tab")), 
+                              f"{runname}_MCMC_psrf.key")
+                break
             print(f"Help! {runname} is being repressed!")
+            if attempts < maxattempts:  # Full-jitter exponential backoff before retrying
+                time.sleep(random.uniform(0, min(30.0, 2 ** attempts)))
+        else:  # If attempts ran out without producing tabfile
+            raise RuntimeError(f"{runname}_MCMC_stats.tab not created after {maxattempts} attempts")
     else:
         print(f"Help! {runname}_MCMC_stats.dat file does not exist!")
 
 
+def _read_psrf_rows(tabfile):
+    """Stream MCMC_stats.tab file and return DataFrame of only the PSRF 
+    rows, without materialising the (much larger) remaining stats rows
+    """
+    with open(tabfile, 'r') as f:
+        header = next(f).rstrip('\r\n').split('\t')
+        names, rows = [], []
+        for line in f:
+            if 'PSRF' not in line:  # Cheap substring check before splitting
+                continue
+            parts = line.rstrip('\r\n').split('\t')
+            if 'PSRF' not in parts[0] or parts[0] == 'PSRF Payoff':  # Except for this one
+                continue
+            names.append(parts[0])
+            row = [float(v) if v.strip() else np.nan for v in parts[1:]]
+            rows.append(row + [np.nan] * (len(header) - 1 - len(row)))  # Pad short rows
+    
+    columns = [int(float(h)) for h in header[1:]]  # Convert columns to int
+    return pd.DataFrame(rows, index=names, columns=columns, dtype=float)
+
+
 def calc_psrf(runname, burnin, thresholds):
     """Using MCMC_stats.tab file (from `compile_psrf` function), return 
     % of PSRF values below each threshold in list of `thresholds`
     """
+    mcout = _read_psrf_cache(runname)  # Reuse parsed PSRF values if tabfile unchanged
     
-    mcout = pd.read_csv(f'{runname}_MCMC_stats.tab', sep='\t', index_col=0)    
-    
-    # Subset to only rows containing PSRF values
-    psrfs = [i for i in mcout.index if 'PSRF' in i]
-    psrfs.remove('PSRF Payoff')  # Except for this one
-    mcout = mcout.loc[psrfs]
+    if mcout is None:
+        tabkey = _file_key(f"./{runname}_MCMC_stats.tab")  # Key on tabfile before parsing it
+        mcout = _read_psrf_rows(f'{runname}_MCMC_stats.tab')
+        _write_psrf_cache(runname, mcout, tabkey)
     
     # Further subset to only simulations after burnin period
-    mcout.columns = mcout.columns.astype('float').astype('int')  # Convert columns to int
     mcout = mcout[mcout.columns[mcout.columns > burnin]].dropna(axis=1)
     
-    return [np.nanmean(mcout < t) for t in thresholds]
+    # Fraction of PSRF values below each threshold, one vectorised comparison per threshold
+    values = mcout.to_numpy(dtype=float)
+    return [float((values < t).mean()) for t in thresholds]
 
 
 # In[ ]:
 
 
-# For widget version, get user input for arguments needed
-runname = input("Enter runname:") 
-vensimpath = input("Enter Vensim .exe path (with extension):")
-burnin = input("Enter MCMC burnin period:")
-thresh_str = input("Enter threshold value[s], separated by commas:")
-
-# Convert threshold input to numeric list
-thresholds = [float(i.strip()) for i in thresh_str.split(',')]
-
-print("Converting .dat file to .tab...")
-compile_psrf(runname, vensimpath)
-print("Calculating PSRF...")
-prop_PSRF = calc_psrf(runname, burnin, thresholds)
-print(f"PSRF values below {thresholds}:")
-print(prop_PSRF)
+def _main(argv=None):
+    """Command-line entry point for batch use, e.g. parallel runs via `xargs -P`"""
+    parser = argparse.ArgumentParser(description="Calculate fraction of post-burnin PSRF values below thresholds")
+    parser.add_argument('--runname', required=True, help="MCMC runname")
+    parser.add_argument('--vensimpath', required=True, help="Vensim .exe path (with extension)")
+    parser.add_argument('--burnin', type=int, default=0, help="MCMC burnin period")
+    parser.add_argument('--thresholds', type=float, nargs='+', required=True, help="Threshold value[s]")
+    args = parser.parse_args(argv)
+    
+    compile_psrf(args.runname, args.vensimpath)
+    print(calc_psrf(args.runname, args.burnin, args.thresholds))
+
+
+# Use command-line arguments if given outside a notebook, otherwise run as interactive widget
+if __name__ == '__main__' and len(sys.argv) > 1 and 'ipykernel' not in sys.modules:
+    _main()
+else:
+    # For widget version, get user input for arguments needed
+    runname = input("Enter runname:") 
+    vensimpath = input("Enter Vensim .exe path (with extension):")
+    burnin = int(input("Enter MCMC burnin period:"))  # Compared against integer sim numbers
+    thresh_str = input("Enter threshold value[s], separated by commas:")
+
+    # Convert threshold input to numeric list
+    thresholds = [float(i.strip()) for i in thresh_str.split(',')]
+
+    print("Converting .dat file to .tab...")
+    compile_psrf(runname, vensimpath)
+    print("Calculating PSRF...")
+    prop_PSRF = calc_psrf(runname, burnin, thresholds)
+    print(f"PSRF values below {thresholds}:")
+    print(prop_PSRF)
 
 
 # In[ ]:
@@ -45,46 +45,72 @@
 # In[ ]:
 
 
-import regex
-from shutil import copy
+import os
+import re
+import sys
+import argparse
+import tempfile
+from shutil import copy, copymode
+
+
+# Compile regex to identify varnames and values from file text
+_INREGEX = re.compile(
+    r"(?:<=\s?)?(?!\s)"  # Identify optional '<=' and ignore preceding whitespace
+    r"([a-zA-Z0-9\s\[\],_]*)"  # Capture varname, possibly including [],_
+    r"(?<! )\s*=\s*"  # Ignore trailing whitespace on varname and identify '='
+    r"(-?(?:0|[1-9]\d*)(?:\.\d*)?"  # Capture value, incl. -. scientific notation
+    r"(?:[eE][+\-]?\d+)?)(?:\s*<=)?"  # Capture scientific notation and identify optional '<='
+)
+
+# Numeric value, incl. -. scientific notation, in syntax Vensim can read
+_NUMBER = r"-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?"
+_NUMREGEX = re.compile(_NUMBER)
+
+# Pattern for '=' and existing numeric value following a varname in model file
+_MDLVALUE = r"\s*=\s*(" + _NUMBER + r")"
+
+
+def _is_number(text):
+    """Check whether `text` is a number in the same syntax as `_MDLVALUE`"""
+    return _NUMREGEX.fullmatch(text) is not None
 
 
 def update_mdl_params(inputfile, mdlfile):
     """Read parameter values from `inputfile` and replace corresponding 
     parameter values in `mdlfile`
     """
-    
-    # Compile regex to identify varnames and values from file text
-    inregex = regex.compile(
-        r"(?:<=\s?)?(?!\s)"  # Identify optional '<=' and ignore preceding whitespace
-        r"([a-zA-Z0-9\s\[\],_]*)"  # Capture varname, possibly including [],_
-        r"(?<! )\s*=\s*"  # Ignore trailing whitespace on varname and identify '='
-        r"(-?(?:0|[1-9]\d*)(?:\.\d*)?"  # Capture value, incl. -. scientific notation
-        r"(?:[eE][+\-]?\d+)?)(?:\s*<=)?"  # Capture scientific notation and identify optional '<='
-    )
-
+    results = []  # List of (varname, value) tuples
     with open(inputfile, 'r') as f:
-        lines = [line for line in f.readlines() if line[0] != ':']  # Ignore control/comment lines
-        text = ''.join(lines)
-
-    results = regex.findall(inregex, text)  # Pull out list of (varname, value) tuples
+        for line in f:
+            if line[0] == ':':
+                continue  # Ignore control/comment lines
+            # Fast path for plain 'varname = value' lines; fall back to regex otherwise
+            left, sep, right = line.partition('=')
+            if sep and '<' not in left and _is_number(right.strip()):
+                results.append((left.strip(), right.strip()))
+            else:
+                results.extend(_INREGEX.findall(line))
 
     copy(mdlfile, f'./{mdlfile[:-4]}_BACKUP{mdlfile[-4:]}')  # Create backup copy of model file
 
     with open(mdlfile, 'r') as m:
         mdl = m.read()
+    
+    values = dict(results)  # Map varnames to new values; later duplicates take precedence
+    if values:
+        # Substitute all variables in a single pass, using one alternation of all varnames 
+        # (longest first) and looking up each matched varname's new value
+        varregex = re.compile(r"\n("  # Include linebreak to avoid varname substrings
+                                 + '|'.join(map(re.escape, sorted(values, key=len, reverse=True)))
+                                 + r")" + _MDLVALUE)  # Combine varnames with existing value
+        mdl = varregex.sub(lambda match: f"\n{match.group(1)} = {values[match.group(1)]}", mdl)
         
-        for var, val in results:  # Loop through list of regex results
-            varregex = regex.compile(r"\n"  # Include linebreak to avoid varname substrings
-                                     + regex.escape(var)  # Combine varname with existing value
-                                     + r"\s*=\s*(-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?)")
-            mdl = varregex.sub(f"{var} = {val}", mdl)  # Substitute new varname and value
-
-        ### TODO: consider whether loop necessary or substitution can be done simultaneously
-        ### using compiled match pattern with '|'.join
-        
-    with open(mdlfile, 'w') as m:  # Write output to model
+    # Write output to temp file alongside model, then swap it in atomically
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(mdlfile) or '.', 
+                                     delete=False) as m:
         m.write(mdl)
+    copymode(mdlfile, m.name)  # Keep original file permissions
+    os.replace(m.name, mdlfile)
 
     print("Substitution complete!")
 
@@ -92,11 +118,25 @@ def update_mdl_params(inputfile, mdlfile):
 # In[ ]:
 
 
-# For widget version, get user input for inputfile and mdlfile
-inputfile = input("Enter variable input filename (with extension):")
-mdlfile = input("Enter model filename (with extension):")
+def _main(argv=None):
+    """Command-line entry point for batch use, e.g. parallel runs via `xargs -P`"""
+    parser = argparse.ArgumentParser(description="Overwrite mdl parameter values with values from input file")
+    parser.add_argument('inputfile', help="Variable input filename (with extension)")
+    parser.add_argument('mdlfile', help="Model filename (with extension)")
+    args = parser.parse_args(argv)
+    
+    update_mdl_params(args.inputfile, args.mdlfile)
+
+
+# Use command-line arguments if given outside a notebook, otherwise run as interactive widget
+if __name__ == '__main__' and len(sys.argv) > 1 and 'ipykernel' not in sys.modules:
+    _main()
+else:
+    # For widget version, get user input for inputfile and mdlfile
+    inputfile = input("Enter variable input filename (with extension):")
+    mdlfile = input("Enter model filename (with extension):")
 
-update_mdl_params(inputfile, mdlfile)
+    update_mdl_params(inputfile, mdlfile)
 
 
 # In[ ]:
@@ -19,8 +19,41 @@
 # In[ ]:
 
 
-import regex
+import os
+import re
+import sys
 import json
+import argparse
+import tempfile
+import functools
+from shutil import copymode
+from concurrent.futures import ThreadPoolExecutor
+
+
+@functools.lru_cache(maxsize=32)
+def _subs_regex(keys):
+    """Compile (and cache) alternation regex matching any of `keys`, 
+    longest first so substrings of longer keys don't match early"""
+    substrings = sorted(keys, key=len, reverse=True)  # Arrange replacement keys by length
+    return re.compile('|'.join(map(re.escape, substrings)))
+
+
+def build_replacer(subs):
+    """Build text replacement function for `subs`, compiling the match 
+    pattern once so it can be reused across many strings or files
+    
+    Parameters
+    ----------
+    subs : dict of str
+        Dict of old strings to replace with matching new strings
+        
+    Returns
+    -------
+    function
+        Function taking a str and returning it with replacements made
+    """
+    regexp = _subs_regex(tuple(subs))
+    return lambda string: regexp.sub(lambda match: subs[match.group(0)], string)
 
 
 def rep_strings(string, subs):
@@ -41,41 +74,74 @@ def rep_strings(string, subs):
     str
         Text with replacements made
     """
-    substrings = sorted(subs, key=len, reverse=True)  # Arrange replacement keys by length
-    regexp = regex.compile('|'.join(map(regex.escape, substrings)))
-    return regexp.sub(lambda match: subs[match.group(0)], string)
-
-
-def rep_text(filelist, varnamedict):
+    return build_replacer(subs)(string)
+
+
+def _rep_file(file, replace):
+    """Apply `replace` function to text of `file`, overwriting it"""
+    print(f"Modifying {file}...")
+    # Stream replacements line by line into a temp file alongside the original, 
+    # then swap it in atomically so a crash can't leave a half-written file
+    with open(file, 'r') as fin, tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(file) or '.', delete=False) as fout:
+        try:
+            for line in fin:
+                fout.write(replace(line))
+        except BaseException:
+            fout.close()
+            os.remove(fout.name)
+            raise
+    copymode(file, fout.name)  # Keep original file permissions
+    os.replace(fout.name, file)
+
+
+def rep_text(filelist, varnamedict, max_workers=None):
     """Replace text using `rep_strings` in multiple files; `filelist` is 
     list of file names/paths w/ extensions, can be absolute or relative 
     to working directory; `varnamedict` is json-format dictionary of str 
-    keys and replacements; NOTE overwrites `filelist` files inplace
+    keys and replacements; files are processed concurrently by up to 
+    `max_workers` threads; NOTE overwrites `filelist` files inplace
     """
     
     with open(filelist, 'r') as fl:
-        files = fl.read().splitlines()
+        files = list(filter(None, fl.read().splitlines()))  # Ignores empty lines in filelist
     subs = json.load(open(varnamedict, 'r'))  # Read replacements dict
 
-    for file in list(filter(None, files)):  # Ignores empty lines in filelist
-        print(f"Modifying {file}...")
-        with open(file, 'r') as f:
-            old = f.read()
-
-        new = rep_strings(old, subs)
-        with open(file, 'w') as f:
-            f.write(new)
+    replace = build_replacer(subs)  # Same replacements for every file
+    
+    if len(files) < 2:  # Not worth starting a pool
+        for file in files:
+            _rep_file(file, replace)
+    else:  # Files are independent, so overlap their I/O; list() re-raises any errors
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda file: _rep_file(file, replace), files))
 
 
 # In[ ]:
 
 
-# For widget version, get user input for filelist and varnamedict
-filelist = input("Enter FileList (with extension):") 
-varnamedict = input("Enter VarNameDict (with extension):")
+def _main(argv=None):
+    """Command-line entry point for batch use, e.g. parallel runs via `xargs -P`"""
+    parser = argparse.ArgumentParser(description="Replace text in listed files per json dictionary")
+    parser.add_argument('filelist', help="FileList filename (with extension)")
+    parser.add_argument('varnamedict', help="VarNameDict filename (with extension)")
+    parser.add_argument('--max-workers', type=int, default=None, help="Max concurrent file threads")
+    args = parser.parse_args(argv)
+    
+    rep_text(args.filelist, args.varnamedict, args.max_workers)
+    print("Job done!")
+
+
+# Use command-line arguments if given outside a notebook, otherwise run as interactive widget
+if __name__ == '__main__' and len(sys.argv) > 1 and 'ipykernel' not in sys.modules:
+    _main()
+else:
+    # For widget version, get user input for filelist and varnamedict
+    filelist = input("Enter FileList (with extension):") 
+    varnamedict = input("Enter VarNameDict (with extension):")
 
-rep_text(filelistname, varnamedict)
-print("Job done!")
+    rep_text(filelist, varnamedict)
+    print("Job done!")
 
 
 # In[ ]:
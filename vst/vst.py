@@ -8,14 +8,18 @@
 
 import os
 import subprocess
-import regex
 import json
+import functools
 import time
+import random
 import numpy as np
 import pandas as pd
 from vst_text import *
-from keyboard import press
-from shutil import copy
+from shutil import copymode, SameFileError
+from concurrent.futures import ThreadPoolExecutor
+
+# Suppress console window for each child process (flag only exists on Windows)
+_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
 
 
 # ## `Script` objects
@@ -55,7 +59,7 @@ from shutil import copy
 # 5. `policy/scenario cins` - CIN files (individual policies/scenarios)
 # 
 # #### logfile
-# File used for shared progress & error logging with `write_log` (**TODO:** switch to using `logging` module)
+# File used for shared progress & error logging with `write_log`, which keeps the logfile open and writes each line immediately; use `close_log` to release it
 # 
 # #### sfxs
 # A `dict` of `simcontrol` entries, such as payoff `vpd` or sensitivity control `vsc`, and corresponding string suffixes to modify them with. For instance, if the `simcontrol` specified payoff file is `foo.vpd`, specifying `payoff: '_b'` would modify the payoff file for this `Script` instance to `foo_b.vpd`. Useful for specifying different model or simulation control file versions, denoted by automatically assigned suffixes, for different `Script` instances. Any suffixes specified for missing `simcontrol` entries will be quietly ignored.
@@ -86,12 +90,75 @@ from shutil import copy
 # 
 # Because `run_vengine_script` has seen more use, its exception handling is better developed. (Also, Vengine has more bugs.) If needed, you could modify `run_vensim_script` using similar checks, e.g. incorporating a time limit. Get creative. Learn from painful experience.
 # 
+# For batches of independent runs (e.g. scenario sweeps), `run_vensim_scripts` runs several already-written `.cmd` files through `run_vensim_script` concurrently, bounded by `max_concurrent` (default 2; raise it only as far as your core count and Vensim licence allow). Since `compile_script` may change working directory, write the `.cmd` files first rather than calling `compile_script` concurrently.
+# 
 # #### Check functions
 # The `check_func` argument to `run_vengine_script` allows use of helper functions to catch additional bugs in Vengine output (e.g. nonexistent output, zeroing bug, inconsistent payoffs...); the helper functions should return `True` only if no bugs of concern have occurred. If checks fail, `run_vengine_script` will rerun itself. Existing check functions and the bugs they catch are detailed in `VST-Text.ipynb`.
 
 # In[ ]:
 
 
+def _fastcopy(src, dst):
+    """Copy file `src` to `dst` (file or directory), using in-kernel
+    copy_file_range or sendfile where available and falling back to a
+    buffered read/write loop otherwise
+    """
+    if os.path.isdir(dst):  # Mirror shutil.copy handling of directory dst
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):  # O_TRUNC would empty src
+        raise SameFileError(f"{src!r} and {dst!r} are the same file")
+    binary = getattr(os, 'O_BINARY', 0)  # Needed on Windows to avoid newline translation
+    infd = os.open(src, os.O_RDONLY | binary)
+    try:
+        outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | binary, 0o666)
+        try:
+            size, copied = os.fstat(infd).st_size, 0
+            try:  # Kernel-side copy, can reflink on CoW / NFS (Linux only)
+                while copied < size:
+                    sent = os.copy_file_range(infd, outfd, size - copied, copied, copied)
+                    if not sent:
+                        break
+                    copied += sent
+            except (AttributeError, OSError):
+                try:  # Kernel-side copy via sendfile (not available on Windows)
+                    os.lseek(outfd, copied, os.SEEK_SET)
+                    while copied < size:
+                        sent = os.sendfile(outfd, infd, copied, size - copied)
+                        if not sent:
+                            break
+                        copied += sent
+                except (AttributeError, OSError):  # Plain buffered copy as last resort
+                    os.lseek(infd, copied, os.SEEK_SET)
+                    os.lseek(outfd, copied, os.SEEK_SET)
+                    while True:
+                        buf = os.read(infd, 256 * 1024)
+                        if not buf:
+                            break
+                        os.write(outfd, buf)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+    copymode(src, dst)  # Copy permission bits as shutil.copy does
+
+
+@functools.lru_cache(maxsize=32)
+def _build_header(model, settings, data):
+    """Build .cmd header lines that depend only on simcontrol settings, 
+    cached so Scripts sharing settings reuse them; `settings` is a tuple 
+    of (name, value) pairs, `data` a tuple of data files or None
+    """
+    cmdtext = ["SPECIAL>NOINTERACTION\n", f"SPECIAL>LOADMODEL|{model}\n"]
+    
+    for s, v in settings:
+        cmdtext.append(f"SIMULATE>{s}|{v}\n")
+    
+    if data is not None:
+        cmdtext.append(f"SIMULATE>DATA|\"{','.join(data)}\"\n")
+    
+    return tuple(cmdtext)
+
+
 class Script(object):
     """Master object for holding and modifying .cmd script settings, 
     creating .cmd files, and running them through Vensim/Vengine
@@ -129,12 +196,12 @@ class Script(object):
         
         # Set core simcontrol attributes from controlfile
         for k, v in controlfile['simcontrol'].items():
-            self.__setattr__(k, v if isinstance(v, str) else v.copy())
+            self.__dict__[k] = v if isinstance(v, str) else v.copy()
 
         # Modify mdl, voc, etc. with suffixes specified as dict
         for s, sfx in sfxs.items():
             if hasattr(self, s):  # Unneeded sfxs quietly ignored
-                self.__setattr__(s, getattr(self, s)[:-4] + sfx + getattr(self, s)[-4:])
+                self.__dict__[s] = getattr(self, s)[:-4] + sfx + getattr(self, s)[-4:]
         self.runname = self.basename + name
         
         # Set default run & save cmds by simtype
@@ -151,30 +218,34 @@ class Script(object):
         for cmd in ['runcmd', 'savecmd']:
             if controlfile[cmd]:  # Not triggered by empty string
                 write_log(f'Overwriting default {cmd} with {controlfile[cmd]}!', logfile)
-                self.__setattr__(cmd, controlfile[cmd])
+                self.__dict__[cmd] = controlfile[cmd]
         
         # Update changes with `chglist`    
-        flat = [i for s in 
-                [[c] if isinstance(c, str)  # List-wrap single items to flatten properly
-                 else [f"{self.basename}{name}{c[1]}.out"  # Expand lists in paired tuples
-                       for name in c[0]] if isinstance(c[0], list) 
-                 else [f"{self.basename}{c[0]}{c[1]}.out"]  # Or combine paired string tuples
-                 for c in chglist] for i in s]  # Nested list flattening syntax
+        basename = self.basename
+        flat = []
+        for c in chglist:
+            if isinstance(c, str):  # Single items added as-is
+                flat.append(c)
+                continue
+            suffix = c[1] + ".out"
+            if isinstance(c[0], list):  # Expand lists in paired tuples
+                flat.extend(basename + n + suffix for n in c[0])
+            else:  # Or combine paired string tuples
+                flat.append(basename + c[0] + suffix)
         self.changes.extend(flat)
         self.setvals = setvals
+        
+        # Record which simcontrol settings are present, for use in write_script
+        self._cmd_attrs = tuple(s for s in ['payoff', 'sensitivity', 'optparm', 
+                                            'savelist', 'senssavelist'] if hasattr(self, s))
 
 
     def write_script(self):
         """Write actual .cmd file based on Script attributes"""
         
-        cmdtext = ["SPECIAL>NOINTERACTION\n", f"SPECIAL>LOADMODEL|{self.model}\n"]
-        
-        for s in ['payoff', 'sensitivity', 'optparm', 'savelist', 'senssavelist']:
-            if hasattr(self, s):
-                cmdtext.append(f"SIMULATE>{s}|{getattr(self, s)}\n")
-        
-        if hasattr(self, 'data'):
-            cmdtext.append(f"SIMULATE>DATA|\"{','.join(self.data)}\"\n")
+        cmdtext = list(_build_header(
+            self.model, tuple((s, getattr(self, s)) for s in self._cmd_attrs), 
+            tuple(self.data) if hasattr(self, 'data') else None))  # Cached header
 
         if hasattr(self, 'changes'):
             if len(self.changes) > 0:
@@ -194,10 +265,10 @@ class Script(object):
             ])
         
         # Assign cmdtext list to Script object and write actual cmd file
-        with open(f"{self.runname}.cmd", 'w') as scriptfile:
-            scriptfile.writelines(cmdtext)
-        self.__setattr__('cmdtext', cmdtext)
-        self.__setattr__('cmdfile', f"./{self.runname}.cmd")
+        with open(f"{self.runname}.cmd", 'w', buffering=1 << 18) as scriptfile:
+            scriptfile.write(''.join(cmdtext))  # Join once for a single write call
+        self.__dict__['cmdtext'] = cmdtext
+        self.__dict__['cmdfile'] = f"./{self.runname}.cmd"
                 
 
     def copy_model_files(self, dirname):
@@ -207,14 +278,16 @@ class Script(object):
         os.makedirs(dirname, exist_ok=True)
         os.chdir(f"./{dirname}")
 
-        # Copy needed files, based on updated Script attributes
-        for s in ['model', 'payoff', 'optparm', 'sensitivity', 
-                  'savelist', 'senssavelist', 'cmdfile']:
-            if getattr(self, s, False):  # Default to false if attr does not exist
-                copy(f"../{getattr(self, s)}", "./")
+        # Collect needed files, based on updated Script attributes
+        files = [getattr(self, s) for s in ['model', 'payoff', 'optparm', 'sensitivity', 
+                                            'savelist', 'senssavelist', 'cmdfile']
+                 if getattr(self, s, False)]  # Default to false if attr does not exist
         for slist in ['data', 'changes']:
-            for file in getattr(self, slist):
-                copy(f"../{file}", "./")
+            files.extend(getattr(self, slist))
+        
+        # Copy files concurrently to overlap I/O latency; list() re-raises any copy errors
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda file: _fastcopy(f"../{file}", "./"), files))
 
 
     def compile_script(self, vensimpath, logfile, vengine=True, subdir=None, **kwargs):
@@ -261,7 +334,7 @@ class Script(object):
         
         if subdir:
             if os.path.exists(f"./{self.runname}.out"):  # Copy outfile to parent directory
-                copy(f"./{self.runname}.out", "../")
+                _fastcopy(f"./{self.runname}.out", "../")
             os.chdir('..')  # Return to parent directory from subdirectory
     
         return payoff
@@ -275,9 +348,15 @@ class Script(object):
         """
         path = getattr(self, 'subdir', '.')
         
-        rawdf = pd.read_csv(f"{path}/{self.runname}_MCMC_sample.tab", sep='\t')
+        samplefile = f"{path}/{self.runname}_MCMC_sample.tab"
+        header = pd.read_csv(samplefile, sep='\t', nrows=0).columns  # Probe header only
+        cols = [c for c in header if c != 'Unknown']  # Skip empty 'Unknown' column entirely
+        try:  # Use faster multithreaded pyarrow parser if available
+            rawdf = pd.read_csv(samplefile, sep='\t', usecols=cols, engine='pyarrow')
+        except ImportError:
+            rawdf = pd.read_csv(samplefile, sep='\t', usecols=cols)
         newdf = rawdf.sample(frac=samplefrac)  # Downsample randomly by samplefrac
-        newdf.dropna(axis=1, how='all', inplace=True)  # Remove 'Unknown' column from sample
+        newdf.dropna(axis=1, how='all', inplace=True)  # Remove any other empty columns
         newdf.to_csv(f"{self.runname}_MCMC_sample_frac.tab", sep='\t', index=False)
         
         if remove:  # Optionally remove main MCMC outputs to free up disk space
@@ -291,7 +370,32 @@ class Script(object):
 
 ########################################################################                
 
-### TODO: remove `press` calls
+def _retry_delay(attempts, base=1.0, cap=30.0):
+    """Full-jitter exponential backoff: random delay in seconds before 
+    retry number `attempts`, up to base * 2**attempts (capped at `cap`)"""
+    return random.uniform(0, min(cap, base * 2 ** attempts))
+
+
+def _wait_for_file(path, timeout=2.0):
+    """Poll `path` with exponential backoff (from 10ms, capped at 200ms) 
+    for up to `timeout` seconds until it exists and its size is stable 
+    across two polls, i.e. has been flushed; return whether it exists"""
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    lastsize = -1
+    while True:
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = -1
+        if size >= 0 and size == lastsize:  # Exists and no longer growing
+            return True
+        if time.monotonic() >= deadline:
+            return size >= 0
+        lastsize = size
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
 
 def run_vengine_script(scriptname, vensimpath, logfile, 
                        timelimit=None, outext='.log', check_funcs=[]):
@@ -307,37 +411,35 @@ def run_vengine_script(scriptname, vensimpath, logfile,
     if not check_funcs:  # Sets two default check_funcs, can specify more in function call
         check_funcs = getattr(run_vengine_script, 'check_funcs', [check_restarts, check_zeroes])
     
+    attempts = 0  # Track attempts to pace retries
     while True:
-        proc = subprocess.Popen(f"{vensimpath} \"./{scriptname}.cmd\"")
-        time.sleep(2)
-        press('enter')  # Necessary to bypass the popup message in Vengine
+        attempts += 1
+        proc = subprocess.Popen([vensimpath, f"./{scriptname}.cmd"], creationflags=_NO_WINDOW)
+        checkpath = f"./{scriptname}{outext}"
+        last_mtime = None  # Output file mtime as of previous timeout check
         while True:
             try:  # See if run completes within timelimit
                 proc.wait(timeout=timelimit)
                 break
             except subprocess.TimeoutExpired:  # If timelimit reached, check run status
-                try:  # If Vengine gives error popup on exit, attempt to bypass it
-                    print("Attempting bypass...")
-                    press('enter')
-                    proc.wait(3)  # Process should complete if bypass successful
-                    break
-                except subprocess.TimeoutExpired:
-                    try:  # If bypass unsuccessful, check if run still going
-                        write_log(f"Checking for {scriptname}{outext}...", logfile)
-                        timelag = time.time() - os.path.getmtime(f"./{scriptname}{outext}")
-                        if timelag < (timelimit):  # Compare time since last output with timelimit
-                            write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output, "
-                                      "continuing...", logfile)
-                            continue
-                        else:  # If run seems to have stalled out, kill and restart
-                            proc.kill()
-                            write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output. "
-                                      "Calibration timed out!", logfile)
-                            break
-                    except FileNotFoundError:  # If check fails, kill and restart
+                try:  # Check if run still going, i.e. output updated since last check
+                    write_log(f"Checking for {scriptname}{outext}...", logfile)
+                    mtime = os.stat(checkpath).st_mtime
+                    timelag = time.time() - mtime
+                    if mtime != last_mtime:  # Output has advanced since last check
+                        last_mtime = mtime
+                        write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output, "
+                                  "continuing...", logfile)
+                        continue
+                    else:  # If run seems to have stalled out, kill and restart
                         proc.kill()
-                        write_log("Calibration timed out!", logfile)
+                        write_log(f"At {time.ctime()}, {round(timelag,3)}s since last output. "
+                                  "Calibration timed out!", logfile)
                         break
+                except FileNotFoundError:  # If check fails, kill and restart
+                    proc.kill()
+                    write_log("Calibration timed out!", logfile)
+                    break
         # Check if process successfully completed or bugged out / was killed
         # if proc.returncode != 1:  # Note that Vengine returns 1 on MENU>EXIT, not 0!
         ### TODO: Update this when Vengine return codes are fixed
@@ -346,6 +448,7 @@ def run_vengine_script(scriptname, vensimpath, logfile,
         if not (proc.returncode == 0 or proc.returncode == 3221225477):
             write_log(f"Return code is {proc.returncode}", logfile)
             write_log("Vensim! Trying again...", logfile)
+            time.sleep(_retry_delay(attempts))  # Back off to avoid hammering Vensim
             continue
         else: write_log(f"Return code is {proc.returncode}", logfile)
         try:  # If process completed successfully, run final check for errors in output
@@ -355,9 +458,7 @@ def run_vengine_script(scriptname, vensimpath, logfile,
             write_log("Outfile not found! That's it, I'm dead.", logfile)
             pass
     
-    time.sleep(2)
-
-    if os.path.exists(f"./{scriptname}.out"):
+    if _wait_for_file(f"./{scriptname}.out"):  # Give outfile a moment to appear if needed
         payoffvalue = read_payoff(f"{scriptname}.out", logfile)
         write_log(f"Payoff for {scriptname} is {payoffvalue}, calibration complete!", logfile)
         return payoffvalue # For optimisation runs, return payoff
@@ -372,18 +473,25 @@ def run_vensim_script(scriptname, vensimpath, logfile, maxattempts=10, outext='.
     attempts = 0
     while attempts < maxattempts:
         attempts += 1  # Track & update number of attempts to prevent infinite loop
-        if os.path.exists(f"./{scriptname}{outext}"):
-            os.remove(f"./{scriptname}{outext}")  # Delete old output file if needed
+        try:  # Delete old output file if needed, without a separate existence check
+            os.remove(f"./{scriptname}{outext}")
+        except FileNotFoundError:
+            pass
         try:
-            subprocess.run(f"{vensimpath} \"./{scriptname}.cmd\"", check=True)
+            subprocess.run([vensimpath, f"./{scriptname}.cmd"], check=True, 
+                           creationflags=_NO_WINDOW)
             pass
         except subprocess.CalledProcessError:
             print("Vensim! Trying again...")
+            if attempts < maxattempts:  # Back off before retrying
+                time.sleep(_retry_delay(attempts))
             continue
         if os.path.exists(f"./{scriptname}{outext}"):  # Check for output file
             break
         else:
             write_log(f"Help! {scriptname} is being repressed!", logfile)
+            if attempts < maxattempts:  # Back off before retrying
+                time.sleep(_retry_delay(attempts))
             continue
     
     if os.path.exists(f"./{scriptname}.out"):
@@ -393,6 +501,19 @@ def run_vensim_script(scriptname, vensimpath, logfile, maxattempts=10, outext='.
     return 0  # Set default payoff value for simtypes that don't generate one
 
 
+def run_vensim_scripts(scriptnames, vensimpath, logfile, max_concurrent=2, **kwargs):
+    """Run several independent, already-written command scripts in the 
+    working directory through Vensim concurrently, up to `max_concurrent` 
+    at a time, each using `run_vensim_script` (with `kwargs`) for retries; 
+    return list of payoffs in the same order as `scriptnames`
+    """
+    # Each worker thread mostly blocks waiting on its Vensim process, so threads suffice
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        return list(executor.map(
+            lambda scriptname: run_vensim_script(scriptname, vensimpath, logfile, **kwargs), 
+            scriptnames))
+
+
 # In[ ]:
 
 
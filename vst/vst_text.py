@@ -5,8 +5,35 @@
 
 
 import os
+import mmap
 import regex
+import tempfile
+import atexit
+import threading
+import functools
 import numpy as np
+from shutil import copymode
+
+try:  # Optional, speeds up subset_lines with many keys
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+# Precompile fixed regexes used by helper functions below; bytes patterns match raw file 
+# contents directly, skipping decoding
+_FLOAT_RE = regex.compile(rb'-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?')  # Numeric value
+_RESTART_RE = regex.compile(rb':RESTART_MAX\s*=?\s*(\d+)')  # Number of restarts in .out file
+_SEED_RE = regex.compile(rb':SEED=(\d+)')  # Random number seed in .VOC file
+
+# Fields of .out file line, i.e. '[lower <=] name = value [<= upper]'
+_OUTLINE_RE = regex.compile(r'^\s*(?:(\S+)\s*<\s*=\s*)?([^=]+?)\s*=\s*(\S+)(?:\s*<\s*=\s*(\S+))?')
+
+_MMAP_MIN_SIZE = 1 << 16  # Files smaller than this (bytes) are read outright, not mmapped
+_LOG_HANDLES = {}  # Open line-buffered handle for each logfile used by write_log
+_LOG_LOCK = threading.Lock()
+
+_AHOCORASICK_MIN_KEYS = 8  # Use Aho-Corasick automaton in subset_lines above this many keys
 
 
 # 
@@ -34,29 +61,89 @@ import numpy as np
 
 
 def write_log(string, logfile):
-    """Writes printed script output to a logfile"""
-    with open(logfile,'a') as f:
+    """Writes printed script output to a logfile, keeping the logfile 
+    open for reuse by later calls until `close_log`"""
+    path = os.path.abspath(logfile)  # Relative logfile paths follow working directory
+    with _LOG_LOCK:  # Concurrent runs may share a logfile
+        f = _LOG_HANDLES.get(path)
+        if f is None:
+            f = _LOG_HANDLES[path] = open(path, 'a', buffering=1)
         f.write(string + "\n")
     print(string)
 
 
-def get_value(file, varname):
-    """General purpose function for reading values from .mdl, .out, etc. 
-    files; returns value matching `varname` in a 'var = val' syntax
+def close_log(logfile):
+    """Closes `logfile` if held open by `write_log`, e.g. to release it 
+    for other programs; later `write_log` calls will reopen it"""
+    with _LOG_LOCK:
+        f = _LOG_HANDLES.pop(os.path.abspath(logfile), None)
+    if f is not None:
+        f.close()
+
+
+@atexit.register
+def _close_logs():
+    """Close any logfiles opened by `write_log` on interpreter exit"""
+    for f in _LOG_HANDLES.values():
+        f.close()
+
+
+@functools.lru_cache(maxsize=1024)
+def _values_regex(varnames):
+    """Compiles (once per tuple of `varnames`) bytes regex matching any of 
+    `varnames` and its value in 'var = val' syntax
     """
-    varregex = regex.compile(
-        r'(?<=([^\w ]|\n)\s?'  # Identify optional leading <= e.g. in outfile
-        + regex.escape(varname)  # Identify variable name
-        + r'\s*=)\s*-?(?:\d*)(\.\d*)?([eE][+\-]?\d+)?' # Capture value following = sign
+    return regex.compile(
+        rb'(?<=(?:[^\w \x80-\xff]|\n)\s?)'  # Identify optional leading <= e.g. in outfile, 
+                                             # treating non-ASCII (UTF-8) bytes as name characters
+        + rb'(?P<name>' + b'|'.join(regex.escape(v.encode())  # Identify variable names,
+                                    for v in sorted(varnames, key=len, reverse=True))  # longest first
+        + rb')\s*=(?P<value>\s*-?(?:\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?)' # Capture value following = sign
     )
     ### TODO: double check whether this regex pattern works with variable names 
     ### containing numbers or special characters
+
+
+def _match_values(varregex, filetext, count):
+    """Returns dict of first value found for each varname matched by 
+    `varregex` in `filetext`, stopping once `count` varnames are found
+    """
+    values = {}
+    for match in varregex.finditer(filetext):
+        name = match.group('name').decode()
+        if name in values:  # Only first match counts, so don't convert later ones
+            continue
+        values[name] = float(match.group('value'))  # Convert to numeric
+        if len(values) == count:
+            break
+    return values
+
+
+def get_values(file, varnames):
+    """Reads values of multiple `varnames` from .mdl, .out, etc. files 
+    in a single pass; returns dict of varname: value in 'var = val' 
+    syntax, omitting any varnames not found
+    """
+    varnames = tuple(dict.fromkeys(varnames))  # Deduplicate, preserving order
+    if not varnames:
+        return {}
+    varregex = _values_regex(varnames)
     
-    with open(file, 'r') as f:
-        filetext = f.read()
-        value = float((regex.search(varregex, filetext))[0]) # Convert to numeric
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_MIN_SIZE:  # Small files cheaper to read outright
+            values = _match_values(varregex, f.read(), len(varnames))
+        else:  # Map large files so only pages up to the last match are read, with no str copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                values = _match_values(varregex, mm, len(varnames))
+
+    return values
 
-    return value
+
+def get_value(file, varname):
+    """General purpose function for reading values from .mdl, .out, etc. 
+    files; returns value matching `varname` in a 'var = val' syntax
+    """
+    return get_values(file, [varname])[varname]
 
     
 def read_payoff(outfile, logfile):
@@ -69,40 +156,72 @@ def read_payoff(outfile, logfile):
     else:
         write_log(f"Warning: attempting to read payoff from {outfile}", logfile)
     
-    with open(outfile, 'r') as f:
-        payoffline = f.readlines()[line]
-    payoffvalue = [float(s) for s in 
-                   regex.findall(r'-?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?', payoffline)][0]
+    path = os.path.abspath(outfile)  # Key cache on absolute path, mtime & size so rewrites are reread
+    stat = os.stat(path)
+    return _parse_payoff(path, line, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_payoff(path, line, mtime_ns, size):
+    """Reads payoff value from specified line of file; cached by `read_payoff`"""
+    with open(path, 'rb') as f:  # Read only up to the needed line
+        for _ in range(line):
+            f.readline()
+        payoffline = f.readline()
+    payoffvalue = float(_FLOAT_RE.search(payoffline).group(0))  # Only first match needed
     return payoffvalue
 
 
 def increment_seed(vocfile, logfile):
     """Increments random number seed in a .VOC file by 1"""
-    with open(vocfile, 'r') as f:
+    with open(vocfile, 'rb') as f:
         vocdata = f.read()
-    seedregex = regex.compile(r':SEED=\d+')
-    try:  # Identify random number seed
-        i = int(regex.search(r'\d+', regex.search(seedregex, vocdata).group()).group())
-        newdata = seedregex.sub(f":SEED={i+1}", vocdata) # Increment by 1
-        with open(vocfile, 'w') as f:
-            f.write(newdata)
-    except:  # If VOC file contains no seed entry
+    match = _SEED_RE.search(vocdata)  # Identify random number seed
+    if match is None:  # If VOC file contains no seed entry
         write_log("No seed found, skipping incrementing.", logfile)
+        return
+    
+    i = int(match.group(1))
+    newdata = _SEED_RE.sub(f":SEED={i+1}".encode(), vocdata) # Increment by 1
+    with open(vocfile, 'wb') as f:
+        f.write(newdata)
         
 
+def _outval_row(outputline):
+    """Splits .out file output line into (name, value, lower, upper) 
+    tuple, filling +/- infinity as needed; used in bulk parsing
+    """
+    m = _OUTLINE_RE.match(outputline)  # Capture all fields in one pass
+    if m is None:  # No 'var = val' syntax, so no value either
+        return (outputline.strip(), np.nan, -np.inf, np.inf)
+    
+    lower, name, value, upper = m.groups()
+    return (name, float(value), 
+            float(lower) if lower else -np.inf, float(upper) if upper else np.inf)
+
+
 def parse_outval(outputline):
     """Splits .out file output line into dict of variable name, value, 
     lower and upper bounds, filling +/- infinity as needed
     """
-    out = [-np.inf, None, np.nan, np.inf]  # Initialise output w/ default values
-    parts = outputline.split('= ')
-    if parts[0].endswith('<'):  # If lower bound specified
-        out[0:len(parts)] = [p.replace(" <", "").strip() for p in parts]
-    else:  # If no lower bound specified
-        out[1:len(parts)+1] = [p.replace(" <", "").strip() for p in parts]
-    
-    return {'Name': out[1], 'Value': float(out[2]), 
-            'Lower': float(out[0]), 'Upper': float(out[3])}
+    return dict(zip(['Name', 'Value', 'Lower', 'Upper'], _outval_row(outputline)))
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_outvals(path, mtime_ns, size):
+    """Parses full .out file into tuple of (name, value, lower, upper) 
+    tuples; cached (immutably) by `_outvals`
+    """
+    with open(path, 'r') as f:  # Build row tuples directly, without intermediate dicts
+        return tuple(_outval_row(line) for line in f 
+                     if not line.startswith(':'))  # Ignore controls & comments
+
+
+def _outvals(filename):
+    """Returns parsed .out file rows, reparsing only if file has changed"""
+    path = os.path.abspath(filename)  # Key cache on absolute path, mtime & size
+    stat = os.stat(path)
+    return _parse_outvals(path, stat.st_mtime_ns, stat.st_size)
 
 
 def read_outvals(filename, transpose=False):
@@ -110,14 +229,25 @@ def read_outvals(filename, transpose=False):
     values, lower and upper bounds, filling +/- infinity as needed; if 
     `transpose` is specified, converts into dict of tuples instead
     """
-    with open(filename, 'r') as f:
-        output = [line for line in f.readlines() if line[0] != ':']  # Ignore controls & comments
+    outvals = _outvals(filename)
     
     if transpose:
         return dict(zip(['Name', 'Value', 'Lower', 'Upper'],  # Respecify dict keys
-                        zip(*[parse_outval(line).values() for line in output])))
+                        zip(*outvals)))
     else:
-        return [parse_outval(line) for line in output]
+        return [dict(zip(['Name', 'Value', 'Lower', 'Upper'], v)) for v in outvals]
+    
+
+def read_outvals_np(filename):
+    """Converts full .out file into dict of NumPy arrays of variable 
+    names, values, lower and upper bounds, filling +/- infinity as 
+    needed; suited to vectorised checks across all parameters
+    """
+    outvals = _outvals(filename)
+    
+    return {'Name': np.array([v[0] for v in outvals], dtype=object), 
+            **{key: np.fromiter((v[i] for v in outvals), dtype=float, count=len(outvals)) 
+               for i, key in enumerate(['Value', 'Lower', 'Upper'], 1)}}
     
 
 def subset_lines(filename, linekey):
@@ -126,13 +256,34 @@ def subset_lines(filename, linekey):
     of strings to keep); can be used to subset an .out file to a single 
     subscript element to prevent loading errors
     """
-    with open(filename,'r') as f:
-        filedata = f.readlines()
-
-    newdata = [line for line in filedata if any(k in line for k in linekey)]
+    keys = tuple(linekey)
+    if '' in keys:  # Empty key is in every line, so keep all (automaton never matches it)
+        keep = lambda line: True
+    elif ahocorasick is not None and len(keys) > _AHOCORASICK_MIN_KEYS:
+        # Match all keys in one automaton pass per line rather than one search per key
+        automaton = ahocorasick.Automaton()
+        for k in keys:
+            automaton.add_word(k, k)
+        automaton.make_automaton()
+        keep = lambda line: next(automaton.iter(line), None) is not None
+    elif len(keys) > 1:  # Otherwise one alternation regex pass per line
+        keep = regex.compile('|'.join(map(regex.escape, keys))).search
+    else:  # Plain substring check for single key (or none)
+        keep = lambda line: any(k in line for k in keys)
     
-    with open(filename, 'w') as f:
-        f.writelines(newdata)
+    # Stream kept lines to temp file alongside original, then swap it in atomically
+    with open(filename, 'r') as fin, tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(filename) or '.', delete=False) as fout:
+        try:
+            for line in fin:
+                if keep(line):
+                    fout.write(line)
+        except BaseException:  # Don't leave partial temp file behind
+            fout.close()
+            os.remove(fout.name)
+            raise
+    copymode(filename, fout.name)  # Keep original file permissions
+    os.replace(fout.name, filename)
 
 
 # In[ ]:
@@ -165,17 +316,15 @@ def check_restarts(scriptname, logfile):
     indicates hidden optimisation failure (since each optimisation took 
     only one simulation, which is impossible)
     """
-    with open(f"{scriptname}.out",'r') as f0:
-        filedata = f0.readlines()
+    with open(f"{scriptname}.out",'rb') as f0:
+        filetext = f0.read()
+    
+    match = _RESTART_RE.search(filetext)
+    restarts = match.group(1).decode() if match else 0  # Extract number of restarts, or default
+    header = filetext.partition(b'\n')[0].decode()
     
-    restarts = 0 # Assign default value
-    for line in filedata:
-        if ':RESTART_MAX' in line:
-            restarts = regex.findall(r'\d+', line)[0]  # Extract number of restarts
-            break  # Stop looking through lines to save time
-            
     # Ensure number of simulations != number of restarts
-    if f"After {restarts} simulations" in filedata[0]:
+    if f"After {restarts} simulations" in header:
         write_log(f"{scriptname} is Spam, egg, Spam, Spam, bacon, and Spam!", logfile)
         return False  # Fail if simulations = RESTART_MAX value
     return True  # Otherwise pass
@@ -185,18 +334,16 @@ def check_zeroes(scriptname, logfile):
     """Check if an .out file has any parameters incorrectly set to zero 
     (indicates Vengine error), return False if any parameters zeroed
     """
-    checklist = []  # Initialise results container
-    outdata = read_outvals(f"{scriptname}.out")
+    outdata = read_outvals_np(f"{scriptname}.out")
     
-    for line in outdata:
-        if (((0 < line['Lower']) or (0 > line['Upper']))  # If 0 is out of bounds
-            and (line['Value'] == 0)):  # But parameter estimated at 0, indicating bug
-            checklist.append(False)
-            write_log(f"{line['Name']} is no more!", logfile)
-        else:
-            checklist.append(True)
+    zeroed = (((0 < outdata['Lower']) | (0 > outdata['Upper']))  # If 0 is out of bounds
+              & (outdata['Value'] == 0))  # But parameter estimated at 0, indicating bug
+    if not zeroed.any():  # Common case; no values incorrectly zeroed, so nothing to log
+        return True
     
-    return all(checklist)  # Only yields True if no values incorrectly zeroed
+    for name in outdata['Name'][zeroed]:
+        write_log(f"{name} is no more!", logfile)
+    return False
 
 
 # In[ ]: